@@ -31,12 +31,24 @@ def do_which_datasets(args):
         print(ds["path"])
 
 
-def do_report_merged_data(args):
+def report_writer(args):
     from arkitools.merge import (
-        merge_data, simple_merger, Vm2FlagsMerger,
-        ReportMergedWriter,
+        ReportMergedWriter, PartitionedReportMergedWriter,
     )
 
+    if args.manifest_file and not args.outdir:
+        raise Exception("--manifest-file requires --outdir")
+
+    if args.outdir:
+        return PartitionedReportMergedWriter(args.outdir, args.to_delete_file,
+                                             args.manifest_file)
+    else:
+        return ReportMergedWriter(args.outfile, args.to_delete_file)
+
+
+def do_report_merged_data(args):
+    from arkitools.merge import merge_data, simple_merger, Vm2FlagsMerger
+
     merger = {
         "simple": simple_merger,
         "vm2flags": Vm2FlagsMerger("all"),
@@ -45,31 +57,76 @@ def do_report_merged_data(args):
 
     merge_data(infiles=args.infile, dsconf=args.conf,
                merger=merger,
-               writer=ReportMergedWriter(args.outfile, args.to_delete_file))
+               writer=report_writer(args),
+               bytes_per_second=args.bwlimit,
+               progress=print_progress if args.progress else None)
 
 
 def do_report_deleted_data(args):
-    from arkitools.merge import merge_data, DeleteMerger, ReportMergedWriter
+    from arkitools.merge import merge_data, DeleteMerger
     from tempfile import NamedTemporaryFile
     from subprocess import check_call, DEVNULL
 
+    writer = report_writer(args)
     with NamedTemporaryFile() as fp:
         check_call(["arki-query", "--data", args.query, "-C", args.conf,
                     "-o", fp.name], stdout=DEVNULL)
         merge_data(infiles=[fp.name], dsconf=args.conf,
                    merger=DeleteMerger(args.query),
-                   writer=ReportMergedWriter(args.outfile, args.to_delete_file))
+                   writer=writer,
+                   bytes_per_second=args.bwlimit,
+                   progress=print_progress if args.progress else None)
+
+
+def print_progress(progress):
+    import sys
+
+    eta = "?" if progress.eta is None else "{:.0f}s".format(progress.eta)
+    print("{}/{} done, {}/{} bytes, ETA {}".format(
+        progress.done, progress.total,
+        progress.done_bytes, progress.total_bytes, eta,
+    ), file=sys.stderr)
 
 
 def do_repack_archived_file(args):
-    from arkitools.dataset import repack_archived_file
+    from arkitools.dataset import repack_archived_file, MaintenanceScheduler
+
+    if args.backup_file and len(args.infile) > 1:
+        raise Exception("--backup-file requires a single file to repack")
 
-    return repack_archived_file(
-        infile=args.infile,
-        backup_file=args.backup_file,
-        dry_run=args.dry_run,
-        tmpbasedir=args.tmpdir
+    scheduler = MaintenanceScheduler(
+        max_workers=args.jobs,
+        bytes_per_second=args.bwlimit,
+        progress=print_progress if args.progress else None,
     )
+    return scheduler.run(
+        lambda infile: repack_archived_file(
+            infile=infile,
+            backup_file=args.backup_file,
+            dry_run=args.dry_run,
+            tmpbasedir=args.tmpdir
+        ),
+        args.infile
+    )
+
+
+def add_throttle_arguments(parser):
+    parser.add_argument("--bwlimit", type=int,
+                        help="Max archived bytes per second to process")
+    parser.add_argument("--progress", action="store_true",
+                        help="Print progress and ETA")
+
+
+def add_report_output_arguments(parser):
+    parser.add_argument("-d", "--to-delete-file", required=True)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('-o', '--outfile')
+    output.add_argument('-O', '--outdir',
+                        help="Save a file for each merged segment")
+    parser.add_argument('--manifest-file',
+                        help=("List of the files saved in outdir "
+                              "(default: OUTDIR/manifest.list)"))
+    add_throttle_arguments(parser)
 
 
 def main():
@@ -100,7 +157,11 @@ def main():
                                         action="store_true", help="Dry run")
     repack_archived_file_p.add_argument("-b", "--backup-file",
                                         help="Save original data")
-    repack_archived_file_p.add_argument("infile", help="File to repack")
+    repack_archived_file_p.add_argument("-j", "--jobs", type=int, default=1,
+                                        help="Max concurrent repacks")
+    add_throttle_arguments(repack_archived_file_p)
+    repack_archived_file_p.add_argument("infile", help="File to repack",
+                                        nargs="+")
     repack_archived_file_p.set_defaults(func=do_repack_archived_file)
 
     # Which dataset
@@ -125,8 +186,7 @@ def main():
                                       choices=["simple", "vm2flags",
                                                "vm2flags-B33196"],
                                       default="simple")
-    report_merged_data_p.add_argument("-d", "--to-delete-file", required=True)
-    report_merged_data_p.add_argument('-o', '--outfile', required=True)
+    add_report_output_arguments(report_merged_data_p)
     report_merged_data_p.add_argument('conf')
     report_merged_data_p.add_argument('infile', nargs='+')
     report_merged_data_p.set_defaults(func=do_report_merged_data)
@@ -139,8 +199,7 @@ def main():
             "and print a list of files to delete."
         )
     )
-    report_deleted_data_p.add_argument("-d", "--to-delete-file", required=True)
-    report_deleted_data_p.add_argument('-o', '--outfile', required=True)
+    add_report_output_arguments(report_deleted_data_p)
     report_deleted_data_p.add_argument('conf')
     report_deleted_data_p.add_argument('query')
     report_deleted_data_p.set_defaults(func=do_report_deleted_data)
@@ -22,6 +22,9 @@ import shutil
 import subprocess
 import configparser
 import re
+import time
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
 
 
@@ -61,20 +64,51 @@ def create_dataset(ds, ds_type="error", ds_step="daily"):
         out.write("step = {}\n".format(ds_step))
 
 
+def read_summary(infiles):
+    """Return the items of the summary of the given files.
+
+    :param infiles: list of files to summarise.
+    """
+    import json
+    summ = json.loads(subprocess.check_output([
+        "arki-query", "--summary", "--json", ""] + infiles).decode("utf-8"))
+    return summ["items"]
+
+
 def which_datasets(infiles, dsconf):
     """Given a mergeconf, return the datasets that would acquire the
     files as a dict.
 
+    Simple filters are evaluated in-process against the summary of the
+    files, the others with arki-query.
+
     :param infiles: list of files to check.
     :param dsconf: path of the mergeconf file.
     """
+    from .matcher import compile_filter, UnsupportedFilter
+
     cfg = configparser.ConfigParser()
     cfg.read([dsconf])
+    summary = None
     for s in cfg.keys():
         section = dict(cfg.items(s))
         if "filter" not in section or "path" not in section:
             continue
         f = section.get("filter")
+        try:
+            matcher = compile_filter(f)
+        except UnsupportedFilter:
+            matcher = None
+
+        if matcher is not None:
+            if summary is None:
+                summary = read_summary(infiles)
+            matched = matcher.match(summary)
+            if matched is not None:
+                if matched:
+                    yield section
+                continue
+
         r = subprocess.check_output(["arki-query", "--summary", "--dump",
                                     f] + infiles)
         if r and not r.isspace():
@@ -203,3 +237,113 @@ def repack_archived_file(infile, backup_file=None, dry_run=False,
                 shutil.copyfile(infile, backup_file)
 
             shutil.copyfile(outfile, infile)
+
+
+def segment_locality_key(path):
+    """Sort key that groups segments by physical locality (dataset, archive,
+    year directory, file).
+
+    :param path: path of the segment.
+    """
+    return os.path.abspath(path).split(os.sep)
+
+
+MaintenanceProgress = namedtuple("MaintenanceProgress", [
+    "done", "total", "done_bytes", "total_bytes", "elapsed", "eta",
+])
+
+
+class MaintenanceScheduler(object):
+    """Run a maintenance operation over a list of segments.
+
+    The segments are processed in physical locality order, with at most
+    max_workers operations running at the same time and starting the
+    operations at no more than bytes_per_second (None for no limit).
+
+    After each segment, progress is called (if not None) with a
+    MaintenanceProgress object.
+
+    After the first failure, no other operation is started and, when the
+    running ones are finished, an exception listing every failure is
+    raised."""
+    def __init__(self, max_workers=1, bytes_per_second=None, progress=None):
+        if max_workers < 1:
+            raise Exception("Invalid max_workers: {}".format(max_workers))
+        if bytes_per_second is not None and bytes_per_second <= 0:
+            raise Exception(
+                "Invalid bytes_per_second: {}".format(bytes_per_second)
+            )
+        self.max_workers = max_workers
+        self.bytes_per_second = bytes_per_second
+        self.progress = progress
+
+    def run(self, func, paths, size=os.path.getsize, key=segment_locality_key):
+        """Call func(path) for each path and return the results, in
+        locality order.
+
+        :param func: operation to run on each segment.
+        :param paths: list of segments.
+        :param size: function returning the bytes processed for a path.
+        :param key: sort key of the paths.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        paths = sorted(paths, key=key)
+        sizes = [size(p) for p in paths]
+        total_bytes = sum(sizes)
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.max_workers)
+        status = {"done": 0, "done_bytes": 0}
+        start = time.monotonic()
+
+        def on_done(size, future):
+            slots.release()
+            with lock:
+                status["done"] += 1
+                status["done_bytes"] += size
+                if self.progress is None:
+                    return
+                elapsed = time.monotonic() - start
+                done_bytes = status["done_bytes"]
+                if done_bytes:
+                    eta = elapsed * (total_bytes - done_bytes) / done_bytes
+                else:
+                    eta = None
+                self.progress(MaintenanceProgress(
+                    done=status["done"], total=len(paths),
+                    done_bytes=done_bytes, total_bytes=total_bytes,
+                    elapsed=elapsed, eta=eta,
+                ))
+
+        futures = []
+        started_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for path, size in zip(paths, sizes):
+                slots.acquire()
+                if self.bytes_per_second is not None:
+                    delay = (start + started_bytes / self.bytes_per_second -
+                             time.monotonic())
+                    if delay > 0:
+                        time.sleep(delay)
+                if any(f.done() and f.exception() is not None
+                       for f in futures):
+                    # Don't start new operations after a failure
+                    break
+                started_bytes += size
+                future = executor.submit(func, path)
+                future.add_done_callback(
+                    lambda f, size=size: on_done(size, f)
+                )
+                futures.append(future)
+
+        failures = [
+            "{}: {}".format(path, f.exception())
+            for path, f in zip(paths, futures) if f.exception() is not None
+        ]
+        if failures:
+            raise Exception(
+                "Maintenance failed on {} of {} files ({} not started):\n"
+                "{}".format(len(failures), len(paths),
+                            len(paths) - len(futures), "\n".join(failures))
+            )
+        return [f.result() for f in futures]
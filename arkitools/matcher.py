@@ -0,0 +1,246 @@
+# arkitools/matcher - in-process evaluation of arkimet filters
+#
+# Copyright (C) 2015  - ARPA-SIMC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Emanuele Di Giacomo <edigiacomo@arpa.emr.it>
+"""Evaluate a subset of the arkimet filter syntax against the items of a JSON
+summary (as printed by arki-query --summary --json).
+
+Supported clauses:
+- product, origin: positional values (e.g. GRIB1,80,2,11)
+- area: GRIB:key=value,... and VM2,id
+- reftime: comma-separated >=, >, <=, <, = with dates (e.g. >=2015-01-01)
+
+A match can be True, False or None when it cannot be decided from the summary
+(e.g. a reftime interval partially overlapping a summary item).
+"""
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+
+class UnsupportedFilter(Exception):
+    """The filter cannot be evaluated in-process."""
+    pass
+
+
+# Summary keys of the positional values, for each (type, style)
+POSITIONAL_KEYS = {
+    ("origin", "GRIB1"): ("ce", "sc", "pr"),
+    ("origin", "GRIB2"): ("ce", "sc", "pt", "bg", "pr"),
+    ("origin", "BUFR"): ("ce", "sc"),
+    ("product", "GRIB1"): ("or", "ta", "pr"),
+    ("product", "GRIB2"): ("ce", "di", "ca", "no", "tv", "lt"),
+    ("product", "VM2"): ("id",),
+    ("area", "VM2"): ("id",),
+}
+
+
+def any_of(values):
+    """Three-valued or."""
+    values = list(values)
+    if True in values:
+        return True
+    if None in values:
+        return None
+    return False
+
+
+def all_of(values):
+    """Three-valued and."""
+    values = list(values)
+    if False in values:
+        return False
+    if None in values:
+        return None
+    return True
+
+
+def parse_value(value):
+    """Convert a filter value to int, if possible."""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class PositionalMatcher(object):
+    """Match a metadata against positional values (e.g. GRIB1,80,2,11)."""
+    def __init__(self, tag, expr):
+        parts = [p.strip() for p in expr.split(",")]
+        self.tag = tag
+        self.style = parts[0]
+        keys = POSITIONAL_KEYS.get((tag, self.style))
+        if keys is None or len(parts) - 1 > len(keys):
+            raise UnsupportedFilter("{}: {}".format(tag, expr))
+        self.values = []
+        for key, value in zip(keys, parts[1:]):
+            if not value:
+                continue
+            if not re.match(r"^-?\d+$", value):
+                raise UnsupportedFilter("{}: {}".format(tag, expr))
+            self.values.append((key, int(value)))
+
+    def __call__(self, item):
+        md = item.get(self.tag)
+        if md is None or md.get("s") != self.style:
+            return False
+        if any(key not in md for key, _ in self.values):
+            return None
+        return all(md[key] == value for key, value in self.values)
+
+
+class GribAreaMatcher(object):
+    """Match a GRIB area against key=value pairs."""
+    def __init__(self, expr):
+        self.values = {}
+        for pair in expr.split(","):
+            key, sep, value = pair.partition("=")
+            if not sep or not key.strip() or not value.strip():
+                raise UnsupportedFilter("area: GRIB:{}".format(expr))
+            self.values[key.strip()] = parse_value(value.strip())
+
+    def __call__(self, item):
+        md = item.get("area")
+        if md is None or md.get("s") != "GRIB":
+            return False
+        if "va" not in md:
+            return None
+        return all(md["va"].get(k) == v for k, v in self.values.items())
+
+
+def parse_reftime_period(value):
+    """Return the period [begin, end) represented by a (partial) date.
+
+    :param value: date, e.g. 2015, 2015-01, 2015-01-01 12:30.
+    """
+    g = re.match(
+        r"^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2})"
+        r"(?:[ T](\d{1,2})(?::(\d{1,2})(?::(\d{1,2}))?)?)?)?)?$",
+        value
+    )
+    if not g:
+        raise UnsupportedFilter("reftime: {}".format(value))
+    fields = [int(v) for v in g.groups() if v is not None]
+    try:
+        begin = datetime(*(fields + [1, 1][len(fields) - 1:]))
+        if len(fields) == 1:
+            end = begin.replace(year=begin.year + 1)
+        elif len(fields) == 2:
+            end = (begin + timedelta(days=31)).replace(day=1)
+        else:
+            end = begin + [
+                timedelta(days=1), timedelta(hours=1),
+                timedelta(minutes=1), timedelta(seconds=1),
+            ][len(fields) - 3]
+    except (ValueError, OverflowError):
+        raise UnsupportedFilter("reftime: {}".format(value))
+    return begin, end
+
+
+class ReftimeMatcher(object):
+    """Match the reftime interval of a summary item."""
+    def __init__(self, expr):
+        self.begin = None
+        self.end = None
+        for cond in expr.split(","):
+            g = re.match(r"^\s*(>=|<=|>|<|=)\s*(.+?)\s*$", cond)
+            if not g:
+                raise UnsupportedFilter("reftime: {}".format(expr))
+            op, value = g.groups()
+            b, e = parse_reftime_period(value)
+            if op in (">=", "="):
+                self.restrict(b, None)
+            if op == ">":
+                self.restrict(e, None)
+            if op in ("<=", "="):
+                self.restrict(None, e)
+            if op == "<":
+                self.restrict(None, b)
+
+    def restrict(self, begin, end):
+        if begin is not None and (self.begin is None or begin > self.begin):
+            self.begin = begin
+        if end is not None and (self.end is None or end < self.end):
+            self.end = end
+
+    def __call__(self, item):
+        stats = item.get("summarystats")
+        if stats is None:
+            return None
+        b = datetime(*stats["b"])
+        e = datetime(*stats["e"])
+        if self.begin is not None and e < self.begin:
+            return False
+        if self.end is not None and b >= self.end:
+            return False
+        if self.begin is not None and b < self.begin:
+            return None
+        if self.end is not None and e >= self.end:
+            return None
+        return True
+
+
+def compile_alternative(tag, expr):
+    """Compile a single alternative of a clause."""
+    if tag in ("product", "origin"):
+        return PositionalMatcher(tag, expr)
+    if tag == "area":
+        if expr.startswith("GRIB:"):
+            return GribAreaMatcher(expr[len("GRIB:"):])
+        return PositionalMatcher(tag, expr)
+    if tag == "reftime":
+        return ReftimeMatcher(expr)
+    raise UnsupportedFilter("{}: {}".format(tag, expr))
+
+
+class Filter(object):
+    """Compiled arkimet filter."""
+    def __init__(self, expr):
+        self.clauses = []
+        for clause in re.split(r"[;\n]", expr):
+            if not clause.strip():
+                continue
+            tag, sep, value = clause.partition(":")
+            if not sep:
+                raise UnsupportedFilter(clause)
+            self.clauses.append([
+                compile_alternative(tag.strip().lower(), alt.strip())
+                for alt in re.split(r"\s+or\s+", value.strip())
+            ])
+
+    def match_item(self, item):
+        """Match a single summary item."""
+        return all_of(any_of(alt(item) for alt in clause)
+                      for clause in self.clauses)
+
+    def match(self, items):
+        """Return True if at least an item matches, False if no item
+        matches, None if it cannot be decided.
+
+        :param items: list of items of a JSON summary.
+        """
+        return any_of(self.match_item(item) for item in items)
+
+
+@lru_cache(maxsize=None)
+def compile_filter(expr):
+    """Compile an arkimet filter, raising UnsupportedFilter if it cannot be
+    evaluated in-process.
+
+    :param expr: arkimet filter.
+    """
+    return Filter(expr)
@@ -18,13 +18,49 @@
 # Author: Emanuele Di Giacomo <edigiacomo@arpa.emr.it>
 
 
-def merge_data(infiles, dsconf, merger, writer):
+def merge_groups(originals, begin, end):
+    """Split a merge in yearly groups. Return a list of (begin, end,
+    originals), where begin and end are the reftime interval of the group.
+
+    If the year of an archived file cannot be guessed from its path, a single
+    group with the whole interval is returned.
+
+    :param originals: list of archived files involved in the merge.
+    :param begin: datetime of the first new data.
+    :param end: datetime of the last new data.
+    """
+    import re
+    from datetime import datetime
+
+    years = {}
+    for f in originals:
+        g = re.match(r"^(\d{4})/", segment_partition(f)[1])
+        if not g:
+            return [(begin, end, originals)]
+        years.setdefault(int(g.group(1)), []).append(f)
+
+    return [
+        (datetime(y, 1, 1), datetime(y + 1, 1, 1), years.get(y, []))
+        for y in range(begin.year, end.year + 1)
+    ]
+
+
+def merge_data(infiles, dsconf, merger, writer, bytes_per_second=None,
+               progress=None):
     """Create a merge from infiles and archived data involved.
 
     :param infiles: list of new files to merge.
     :param dsconf: datasets involved.
     :param merger: policy for merging.
     :param writer: policy for writing the results.
+    :param bytes_per_second: max archived bytes per second to merge (None
+    for no limit).
+    :param progress: progress callback (see MaintenanceScheduler).
+
+    The merge is done separately for each year (see merge_groups), so the
+    results of a year are written before the merge of the next one starts.
+    The years are merged one at a time with a MaintenanceScheduler, using
+    the size of their archived files.
 
     The merger merge the old and new data in a temporary dataset.
     It is a callable with the following parameters:
@@ -33,12 +69,13 @@ def merge_data(infiles, dsconf, merger, writer):
     - old_dsconf: dsconf of the original datasets
     - new_dsconf: dsconf of the temporary merge dataset.
 
-    The writer write the merged data. It is a callable with the following
-    parameters:
+    The writer write the merged data of each group. It is a callable with
+    the following parameters:
     - old_data: list of old files involved in the merge
     - new_data: list of new files involved in the merge
     - old_dsconf: dsconf of the original datasets
     - new_dsconf: dsconf where the resulting data are merged
+    If the writer has a close method, it is called after the last group.
     """
     import os
     import json
@@ -48,7 +85,7 @@ def merge_data(infiles, dsconf, merger, writer):
     from subprocess import check_call, check_output, DEVNULL
     from .dataset import (
         which_datasets, is_file_within_timeinterval, create_dataset,
-        clone_dataset,
+        clone_dataset, segment_locality_key, MaintenanceScheduler,
     )
 
     # Involved datasets
@@ -61,15 +98,31 @@ def merge_data(infiles, dsconf, merger, writer):
         return []
     b = datetime(*summ["items"][0]["summarystats"]["b"])
     e = datetime(*summ["items"][0]["summarystats"]["e"])
-    # List of archived files involved
-    originals = [
+    # List of archived files involved, in physical locality order
+    originals = sorted([
         f for ds in datasets for f in [
             f for f in glob("{}/.archive/*/*/*.*".format(ds["path"]))
             if not f.endswith(".metadata") and not f.endswith(".summary")
         ]
         if is_file_within_timeinterval(f, b, e, archived=True, step=ds["step"])
-    ]
-    with tempfile.TemporaryDirectory() as tmpdir:
+    ], key=segment_locality_key)
+    groups = merge_groups(originals, b, e)
+
+    def merge_group(begin, end, group_originals, tmpdir):
+        if len(groups) == 1:
+            new_data = infiles
+        else:
+            # New data of the group only
+            new_file = os.path.join(tmpdir, "new" +
+                                    os.path.splitext(infiles[0])[1])
+            check_call(["arki-query", "--data", "-o", new_file,
+                        "reftime:>={},<{}".format(begin.isoformat(),
+                                                  end.isoformat())] + infiles,
+                       stdout=DEVNULL)
+            if not os.path.exists(new_file) or os.path.getsize(new_file) == 0:
+                return []
+            new_data = [new_file]
+
         dsdir = os.path.join(tmpdir, "datasets")
         cloned_datasets = []
         # Create work environment
@@ -89,16 +142,43 @@ def merge_data(infiles, dsconf, merger, writer):
             check_call(["arki-mergeconf", err_ds, dup_ds] + cloned_datasets,
                        stdout=fp)
         # merge data
-        merger(old_data=originals, new_data=infiles, old_dsconf=dsconf,
-               new_dsconf=config)
+        merger(old_data=group_originals, new_data=new_data,
+               old_dsconf=dsconf, new_dsconf=config)
         # arki-check
         check_call(["arki-check", "-f"] + cloned_datasets, stdout=DEVNULL)
         check_call(["arki-check", "-f", "-r"] + cloned_datasets,
                    stdout=DEVNULL)
         # write data
-        writer(old_data=originals, new_data=infiles, old_dsconf=dsconf,
-               new_dsconf=config)
-        return originals
+        writer(old_data=group_originals, new_data=new_data,
+               old_dsconf=dsconf, new_dsconf=config)
+        return group_originals
+
+    # Groups by reftime interval (sortable and readable in errors)
+    groups = {
+        "{}/{}".format(g[0].isoformat(), g[1].isoformat()): g
+        for g in groups
+    }
+
+    def run_group(name):
+        begin, end, group_originals = groups[name]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            return merge_group(begin, end, group_originals, tmpdir)
+
+    scheduler = MaintenanceScheduler(bytes_per_second=bytes_per_second,
+                                     progress=progress)
+    merged = [
+        f for group_merged in scheduler.run(
+            run_group, list(groups),
+            size=lambda name: sum(os.path.getsize(f)
+                                  for f in groups[name][2]),
+            key=lambda name: name,
+        ) for f in group_merged
+    ]
+
+    if hasattr(writer, "close"):
+        writer.close()
+
+    return merged
 
 
 def simple_merger(old_data, new_data, old_dsconf, new_dsconf):
@@ -208,12 +288,155 @@ class ReportMergedWriter(object):
     def __init__(self, outfile, todelete):
         self.outfile = outfile
         self.todelete = todelete
+        for path in (self.outfile, self.todelete):
+            open(path, "w").close()
 
     def __call__(self, old_data, new_data, old_dsconf, new_dsconf):
-        from subprocess import check_call, DEVNULL
-        # Save new data in outfile
-        check_call(["arki-query", "--data", "-C", new_dsconf, "-o",
-                    self.outfile, ""], stdout=DEVNULL)
-        with open(self.todelete, "w") as fp:
+        from subprocess import check_call
+        # Append new data to outfile
+        with open(self.outfile, "ab") as fp:
+            check_call(["arki-query", "--data", "-C", new_dsconf, ""],
+                       stdout=fp)
+        with open(self.todelete, "a") as fp:
             for f in old_data:
                 fp.write(f + "\n")
+
+
+def segment_partition(path, dspath=None):
+    """Return (dataset name, segment name) of a segment, where the segment
+    name is its path relative to the dataset data directory (e.g.
+    2015/01-01.grib1 for both online and archived segments).
+
+    :param path: path of the segment.
+    :param dspath: path of the dataset (None to guess it from .archive).
+    """
+    import os
+
+    parts = os.path.abspath(path).split(os.sep)
+    if dspath is None:
+        if ".archive" not in parts:
+            raise Exception("Cannot find the dataset of {}".format(path))
+        dsparts = parts[:parts.index(".archive")]
+    else:
+        dsparts = os.path.abspath(dspath).split(os.sep)
+    parts = parts[len(dsparts):]
+    if parts and parts[0] == ".archive":
+        parts = parts[2:]
+    return dsparts[-1], "/".join(parts)
+
+
+def summary_count(items):
+    """Number of data in the items of a JSON summary."""
+    return sum(i["summarystats"]["c"] for i in items)
+
+
+class PartitionedReportMergedWriter(object):
+    """Writer for merge_data.
+
+    Save the merged data in outdir, one file per dataset segment, and list
+    each output file in manifest as soon as it is written. The archived files
+    replaced by a segment are appended to todelete after the segment is
+    written, so that the import and the cleanup can start before the end of
+    the merge. When the merge is complete, the END_OF_MANIFEST line is
+    appended to manifest.
+
+    Before listing the archived files without a merged segment, check that
+    the saved data are all the merged data, raising an exception otherwise.
+
+    outdir must be empty or not existing, to avoid mixing the files of
+    different runs."""
+    END_OF_MANIFEST = "#END"
+
+    def __init__(self, outdir, todelete, manifest=None):
+        import os
+
+        self.outdir = outdir
+        self.todelete = todelete
+        self.manifest = manifest or os.path.join(outdir, "manifest.list")
+        if os.path.isdir(outdir) and os.listdir(outdir):
+            raise Exception("Output directory {} is not empty".format(outdir))
+        os.makedirs(outdir, exist_ok=True)
+        for path in (self.manifest, self.todelete):
+            open(path, "w").close()
+
+    def partitions(self, new_dsconf):
+        """Return the list of (dataset name, segment name, segment path) of
+        the segments of the merged datasets, in physical locality order."""
+        import os
+        import re
+        import configparser
+        from .dataset import segment_locality_key
+
+        cfg = configparser.ConfigParser()
+        cfg.read([new_dsconf])
+        segments = []
+        for s in cfg.sections():
+            if not cfg.has_option(s, "path"):
+                continue
+            dspath = cfg.get(s, "path")
+            for root, dirs, files in os.walk(dspath):
+                for name in files:
+                    f = os.path.join(root, name)
+                    dsname, segment = segment_partition(f, dspath)
+                    # Segments are under a step directory (YYYY, YY/YYYY...)
+                    if not re.match(r"^\d+/", segment):
+                        continue
+                    if f.endswith((".metadata", ".summary", ".index",
+                                   ".tmp")):
+                        continue
+                    segments.append((dsname, segment, f))
+
+        return sorted(segments, key=lambda p: segment_locality_key(p[2]))
+
+    def append(self, path, lines):
+        """Append lines to path with a single write."""
+        import os
+
+        if not lines:
+            return
+        with open(path, "a") as fp:
+            fp.write("".join(line + "\n" for line in lines))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def __call__(self, old_data, new_data, old_dsconf, new_dsconf):
+        import os
+        import json
+        from subprocess import check_call, check_output, DEVNULL
+        from .dataset import read_summary
+
+        pending = {}
+        for f in old_data:
+            pending.setdefault(segment_partition(f), []).append(f)
+
+        saved = 0
+        for dsname, segment, f in self.partitions(new_dsconf):
+            outfile = os.path.join(self.outdir, dsname, segment)
+            if os.path.exists(outfile):
+                raise Exception("Segment {} already saved".format(outfile))
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            tmpfile = outfile + ".tmp"
+            saved += summary_count(read_summary([f]))
+            check_call(["arki-query", "--data", "-o", tmpfile, "", f],
+                       stdout=DEVNULL)
+            os.replace(tmpfile, outfile)
+            self.append(self.manifest, [outfile])
+            self.append(self.todelete, pending.pop((dsname, segment), []))
+
+        # Every merged data must be saved before deleting the archived files
+        # without a merged segment
+        merged = summary_count(json.loads(check_output([
+            "arki-query", "--summary", "--json", "-C", new_dsconf, ""
+        ]).decode("utf-8"))["items"])
+        if merged != saved:
+            raise Exception(
+                "Saved {} of {} merged data: some segments of {} "
+                "were not found".format(saved, merged, new_dsconf)
+            )
+
+        self.append(self.todelete, [f for k in sorted(pending)
+                                    for f in pending[k]])
+
+    def close(self):
+        """Mark the end of the manifest."""
+        self.append(self.manifest, [self.END_OF_MANIFEST])
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import time
+import unittest
+
+from .dataset import segment_locality_key, MaintenanceScheduler
+
+
+class TestSegmentLocalityKey(unittest.TestCase):
+    def test_order(self):
+        paths = [
+            "/ds2/.archive/last/2015/01-01.grib1",
+            "/ds1/.archive/last/2016/01-01.grib1",
+            "/ds1/.archive/last/2015/01-02.grib1",
+            "/ds1/.archive/last/2015/01-01.grib1",
+        ]
+        self.assertEqual(sorted(paths, key=segment_locality_key), [
+            "/ds1/.archive/last/2015/01-01.grib1",
+            "/ds1/.archive/last/2015/01-02.grib1",
+            "/ds1/.archive/last/2016/01-01.grib1",
+            "/ds2/.archive/last/2015/01-01.grib1",
+        ])
+
+
+class TestMaintenanceScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name in ["02-01.grib1", "01-01.grib1"]:
+            path = os.path.join(self.tmpdir.name, "2015", name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fp:
+                fp.write(b"x" * 10)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run(self):
+        progress = []
+        scheduler = MaintenanceScheduler(max_workers=2,
+                                         progress=progress.append)
+        self.assertEqual(
+            scheduler.run(os.path.basename, self.paths),
+            ["01-01.grib1", "02-01.grib1"]
+        )
+        self.assertEqual([(p.done, p.done_bytes) for p in progress],
+                         [(1, 10), (2, 20)])
+        self.assertEqual(progress[-1].total_bytes, 20)
+        self.assertEqual(progress[-1].eta, 0)
+
+    def test_size_key(self):
+        sizes = {"a": 5, "b": 10}
+        progress = []
+        scheduler = MaintenanceScheduler(progress=progress.append)
+        self.assertEqual(
+            scheduler.run(str.upper, ["b", "a"], size=sizes.get,
+                          key=lambda name: name),
+            ["A", "B"]
+        )
+        self.assertEqual([p.done_bytes for p in progress], [5, 15])
+
+    def test_bytes_per_second(self):
+        started = []
+
+        def func(path):
+            started.append(time.monotonic())
+
+        scheduler = MaintenanceScheduler(bytes_per_second=100)
+        scheduler.run(func, self.paths)
+        self.assertEqual(len(started), 2)
+        # The second file starts after the 10 bytes of the first one
+        self.assertGreaterEqual(started[1] - started[0], 0.09)
+
+    def test_failure(self):
+        for name in ["03-01.grib1", "04-01.grib1"]:
+            path = os.path.join(self.tmpdir.name, "2015", name)
+            with open(path, "wb") as fp:
+                fp.write(b"x" * 10)
+            self.paths.append(path)
+
+        called = []
+
+        def func(path):
+            called.append(path)
+            raise ValueError("repack failed")
+
+        scheduler = MaintenanceScheduler()
+        with self.assertRaises(Exception) as cm:
+            scheduler.run(func, self.paths)
+        self.assertEqual(len(called), 1)
+        self.assertIn("01-01.grib1: repack failed", str(cm.exception))
+        self.assertIn("3 not started", str(cm.exception))
+
+    def test_invalid(self):
+        for kwargs in [
+            {"max_workers": 0},
+            {"bytes_per_second": 0},
+            {"bytes_per_second": -1},
+        ]:
+            with self.assertRaises(Exception):
+                MaintenanceScheduler(**kwargs)
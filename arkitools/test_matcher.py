@@ -0,0 +1,78 @@
+import unittest
+
+from .matcher import compile_filter, UnsupportedFilter
+
+
+ITEMS = [
+    {
+        "origin": {"t": "origin", "s": "GRIB1", "ce": 80, "sc": 255,
+                   "pr": 22},
+        "product": {"t": "product", "s": "GRIB1", "or": 80, "ta": 2,
+                    "pr": 11},
+        "area": {"t": "area", "s": "GRIB", "va": {"Ni": 169, "Nj": 181,
+                                                   "type": 10}},
+        "summarystats": {"b": [2015, 1, 1, 0, 0, 0],
+                         "e": [2015, 1, 1, 12, 0, 0]},
+    },
+    {
+        "product": {"t": "product", "s": "VM2", "id": 158},
+        "area": {"t": "area", "s": "VM2", "id": 1},
+        "summarystats": {"b": [2015, 2, 1, 0, 0, 0],
+                         "e": [2015, 2, 28, 0, 0, 0]},
+    },
+]
+
+
+class TestFilter(unittest.TestCase):
+    def assertMatch(self, expr, expected):
+        self.assertIs(compile_filter(expr).match(ITEMS), expected)
+
+    def test_empty(self):
+        self.assertMatch("", True)
+        self.assertIs(compile_filter("").match([]), False)
+
+    def test_product(self):
+        self.assertMatch("product: GRIB1,80,2,11", True)
+        self.assertMatch("product: GRIB1,80,,11", True)
+        self.assertMatch("product: GRIB1,80,2,12", False)
+        self.assertMatch("product: GRIB1,80,2,12 or VM2,158", True)
+        self.assertMatch("product: GRIB2,80", False)
+
+    def test_origin(self):
+        self.assertMatch("origin: GRIB1,80", True)
+        self.assertMatch("origin: GRIB1,98", False)
+
+    def test_area(self):
+        self.assertMatch("area: GRIB:Ni=169,Nj=181", True)
+        self.assertMatch("area: GRIB:Ni=170", False)
+        self.assertMatch("area: VM2,1", True)
+
+    def test_reftime(self):
+        self.assertMatch("reftime: =2015-01-01", True)
+        self.assertMatch("reftime: >=2015-01-01,<2015-01-02", True)
+        self.assertMatch("reftime: >2015", False)
+        self.assertMatch("reftime: <2015", False)
+        self.assertMatch("reftime: =2015-01", True)
+        self.assertMatch("reftime: =2015-02-10", None)
+        self.assertMatch("reftime: =2015-01-01 06", None)
+
+    def test_conjunction(self):
+        self.assertMatch("product: GRIB1,80,2,11; reftime: =2015-01", True)
+        self.assertMatch("product: GRIB1,80,2,11; reftime: =2015-02", False)
+        self.assertMatch("product: VM2,158\nreftime: =2015-02-10", None)
+
+    def test_unsupported(self):
+        for expr in [
+            "level: GRIB1,1",
+            "product: BUFR,synop",
+            "product: GRIB1,80,2,11,1",
+            "area: VM2,1:lat=44",
+            "reftime: =yesterday",
+            "reftime: =2015-02-30",
+            "reftime: <=9999",
+            "reftime: =9999",
+            "reftime: =9999-12-31",
+            "product",
+        ]:
+            with self.assertRaises(UnsupportedFilter):
+                compile_filter(expr)
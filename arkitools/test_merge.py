@@ -0,0 +1,235 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from datetime import datetime
+
+from .merge import (
+    merge_data, merge_groups, segment_partition,
+    PartitionedReportMergedWriter,
+)
+
+
+class TestSegmentPartition(unittest.TestCase):
+    def test_archived(self):
+        self.assertEqual(
+            segment_partition("/arkimet/ds/.archive/last/2015/01-01.grib1"),
+            ("ds", "2015/01-01.grib1")
+        )
+
+    def test_online(self):
+        self.assertEqual(
+            segment_partition("/tmp/datasets/ds/2015/01-01.grib1",
+                              "/tmp/datasets/ds"),
+            ("ds", "2015/01-01.grib1")
+        )
+
+    def test_singlefile(self):
+        self.assertEqual(
+            segment_partition("/tmp/datasets/ds/2015/01/01/00.grib1",
+                              "/tmp/datasets/ds"),
+            ("ds", "2015/01/01/00.grib1")
+        )
+
+    def test_unknown_dataset(self):
+        with self.assertRaises(Exception):
+            segment_partition("/tmp/datasets/ds/2015/01-01.grib1")
+
+
+class TestMergeGroups(unittest.TestCase):
+    def test_yearly(self):
+        originals = [
+            "/arkimet/ds/.archive/last/2014/12-31.grib1",
+            "/arkimet/ds/.archive/last/2016/01-01.grib1",
+        ]
+        self.assertEqual(
+            merge_groups(originals, datetime(2014, 12, 31),
+                         datetime(2016, 1, 1)),
+            [
+                (datetime(2014, 1, 1), datetime(2015, 1, 1), originals[:1]),
+                (datetime(2015, 1, 1), datetime(2016, 1, 1), []),
+                (datetime(2016, 1, 1), datetime(2017, 1, 1), originals[1:]),
+            ]
+        )
+
+    def test_unknown_year(self):
+        originals = ["/arkimet/ds/.archive/last/20/2015.grib1"]
+        b, e = datetime(2014, 12, 31), datetime(2016, 1, 1)
+        self.assertEqual(merge_groups(originals, b, e),
+                         [(b, e, originals)])
+
+
+class TestPartitionedReportMergedWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dsdir = os.path.join(self.tmpdir.name, "datasets")
+        self.outdir = os.path.join(self.tmpdir.name, "out")
+        self.todelete = os.path.join(self.tmpdir.name, "todelete.list")
+        self.conf = os.path.join(self.tmpdir.name, "conf")
+        for f in [
+            "ds/config",
+            "ds/index.sqlite",
+            "ds/.archive/last/2015/01-01.grib1",
+            "ds/.archive/last/2015/01-01.grib1.metadata",
+            "ds/.archive/last/2015/01-01.grib1.summary",
+            "ds/2015/01-02.grib1",
+            "ds2/config",
+            "ds2/2015/01/01/00.grib1",
+        ]:
+            path = os.path.join(self.dsdir, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+        with open(self.conf, "w") as fp:
+            for ds in ["ds", "ds2"]:
+                fp.write("[{}]\npath = {}\n\n".format(
+                    ds, os.path.join(self.dsdir, ds)
+                ))
+
+        self.old_data = [
+            "/arkimet/ds/.archive/last/2015/01-01.grib1",
+            "/arkimet/ds/.archive/last/2015/01-02.grib1",
+            "/arkimet/ds/.archive/last/2015/01-03.grib1",
+        ]
+        self.merged_count = 3
+        self.snapshots = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_lines(self, path):
+        with open(path) as fp:
+            return fp.read().splitlines()
+
+    def check_call(self, cmd, stdout=None):
+        # Save the state of the outputs before writing the partition
+        manifest = self.read_lines(os.path.join(self.outdir, "manifest.list"))
+        for f in manifest:
+            self.assertTrue(os.path.exists(f))
+            self.assertFalse(os.path.exists(f + ".tmp"))
+        self.snapshots.append((manifest, self.read_lines(self.todelete)))
+        tmpfile = cmd[cmd.index("-o") + 1]
+        self.assertTrue(tmpfile.endswith(".tmp"))
+        with open(tmpfile, "w") as fp:
+            fp.write("data")
+
+    def check_output(self, cmd):
+        if "-C" in cmd:
+            count = self.merged_count
+        else:
+            count = 1
+        return json.dumps({"items": [
+            {"summarystats": {"c": count}},
+        ]}).encode("utf-8")
+
+    def run_writer(self):
+        writer = PartitionedReportMergedWriter(self.outdir, self.todelete)
+        with mock.patch("subprocess.check_call", self.check_call), \
+                mock.patch("subprocess.check_output", self.check_output):
+            writer(old_data=self.old_data, new_data=[], old_dsconf=None,
+                   new_dsconf=self.conf)
+        return writer
+
+    def test_write(self):
+        self.run_writer()
+        outfiles = [
+            os.path.join(self.outdir, "ds", "2015/01-01.grib1"),
+            os.path.join(self.outdir, "ds", "2015/01-02.grib1"),
+            os.path.join(self.outdir, "ds2", "2015/01/01/00.grib1"),
+        ]
+        self.assertEqual(
+            self.read_lines(os.path.join(self.outdir, "manifest.list")),
+            outfiles
+        )
+        # An archived file is listed only after its partition is written
+        self.assertEqual(self.snapshots, [
+            ([], []),
+            (outfiles[:1], self.old_data[:1]),
+            (outfiles[:2], self.old_data[:2]),
+        ])
+        # Archived files without a partition are listed at the end
+        self.assertEqual(self.read_lines(self.todelete), self.old_data)
+        self.assertFalse(any(
+            f.endswith(".tmp")
+            for _, _, files in os.walk(self.outdir) for f in files
+        ))
+
+    def test_close(self):
+        self.run_writer().close()
+        self.assertEqual(
+            self.read_lines(os.path.join(self.outdir, "manifest.list"))[-1],
+            PartitionedReportMergedWriter.END_OF_MANIFEST
+        )
+
+    def test_outdir_not_empty(self):
+        os.makedirs(self.outdir)
+        open(os.path.join(self.outdir, "manifest.list"), "w").close()
+        with self.assertRaises(Exception):
+            PartitionedReportMergedWriter(self.outdir, self.todelete)
+
+    def test_missing_partition(self):
+        self.merged_count = 4
+        with self.assertRaises(Exception):
+            self.run_writer()
+        self.assertNotIn(self.old_data[2], self.read_lines(self.todelete))
+
+
+class TestMergeData(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ds = os.path.join(self.tmpdir.name, "ds")
+        self.originals = [
+            os.path.join(self.ds, ".archive/last/2014/12-31.grib1"),
+            os.path.join(self.ds, ".archive/last/2015/01-01.grib1"),
+        ]
+        for f in [os.path.join(self.ds, "config")] + self.originals:
+            os.makedirs(os.path.dirname(f), exist_ok=True)
+            with open(f, "w") as fp:
+                fp.write("data")
+        self.infile = os.path.join(self.tmpdir.name, "new.grib1")
+        open(self.infile, "w").close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_call(self, cmd, stdout=None):
+        if cmd[0] == "arki-query":
+            # New data of the group
+            with open(cmd[cmd.index("-o") + 1], "w") as fp:
+                fp.write("data")
+
+    def check_output(self, cmd):
+        return json.dumps({"items": [{"summarystats": {
+            "b": [2014, 12, 31, 0, 0, 0], "e": [2015, 1, 1, 0, 0, 0],
+        }}]}).encode("utf-8")
+
+    def test_merge_by_year(self):
+        calls = []
+        writer = mock.Mock(side_effect=lambda **kwargs: calls.append(
+            ("writer", kwargs["old_data"])
+        ))
+        writer.close.side_effect = lambda: calls.append(("close", None))
+        progress = []
+
+        def merger(**kwargs):
+            calls.append(("merger", kwargs["old_data"]))
+
+        with mock.patch("subprocess.check_call", self.check_call), \
+                mock.patch("subprocess.check_output", self.check_output), \
+                mock.patch("arkitools.dataset.which_datasets",
+                           return_value=[{"path": self.ds,
+                                          "step": "daily"}]):
+            merged = merge_data([self.infile], "conf", merger, writer,
+                                progress=progress.append)
+
+        self.assertEqual(merged, self.originals)
+        self.assertEqual(calls, [
+            ("merger", self.originals[:1]),
+            ("writer", self.originals[:1]),
+            ("merger", self.originals[1:]),
+            ("writer", self.originals[1:]),
+            ("close", None),
+        ])
+        self.assertEqual([p.done_bytes for p in progress], [4, 8])